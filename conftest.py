@@ -0,0 +1 @@
+# Lets pytest import the app's top-level modules (e.g. openai_helper) when run from the repo root
@@ -1,21 +1,143 @@
 import streamlit as st
-from openai import OpenAI
+import asyncio
+import functools
+import json
+import tiktoken
+from openai import OpenAI, AsyncOpenAI, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 import os
 
+# The SDK already backs off on 429s; this caps how many times it retries one request
+_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))
+
+# Upper bound on in-flight async requests, sized to the account's rate-limit tier
+_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "8"))
+
+# Built once at import and shared by every request; treat as read-only
+_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": """You are a knowledgeable Saudi Arabia tourism expert. 
+            Provide detailed recommendations based on the user's preferences.
+            Be specific about locations, activities, and cultural considerations.
+            Keep responses friendly and informative."""
+}
+
+# Sections requested from the model in one structured "Get Recommendations" call
+_RECOMMENDATION_SECTIONS = ["itinerary", "accommodation", "attractions", "etiquette", "budget", "tips"]
+
+_RECOMMENDATION_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "trip_recommendation",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {section: {"type": "string"} for section in _RECOMMENDATION_SECTIONS},
+            "required": _RECOMMENDATION_SECTIONS,
+            "additionalProperties": False
+        }
+    }
+}
+
+# Batch statuses after which no more results will arrive
+_BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Tokenizer shared by the client and the app; counting locally avoids a failed round-trip
+_MAX_PROMPT_TOKENS = 7000
+# Role/delimiter tokens per message plus reply priming, with slack for re-tokenization after truncation
+_MESSAGE_OVERHEAD = 4
+_TOKEN_MARGIN = 100
+_CONTEXT_PREFIX = "Previous context: "
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding() -> tiktoken.Encoding:
+    # Loaded on first use rather than at import: tiktoken downloads the encoding file once
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+@functools.lru_cache(maxsize=None)
+def _fixed_tokens() -> tuple[int, int]:
+    # Token counts of the system prompt and the recommendation schema
+    return count_tokens(_SYSTEM_MESSAGE["content"]), count_tokens(json.dumps(_RECOMMENDATION_FORMAT))
+
+def count_tokens(text: str) -> int:
+    return len(_get_encoding().encode(text))
+
+def truncate_tokens(text: str, max_tokens: int, keep_end: bool = False) -> str:
+    tokens = _get_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    # A cut can land inside a multibyte character (e.g. Arabic), which decodes to U+FFFD
+    if keep_end:
+        return _get_encoding().decode(tokens[-max_tokens:]).lstrip("\ufffd")
+    return _get_encoding().decode(tokens[:max_tokens]).rstrip("\ufffd")
+
+def split_context(lines: list[str], max_tokens: int, start: int = 0, min_lines: int = 1) -> tuple[int, list[str]]:
+    # Lines before `start` are already summarized. The cut-off only moves forward once the
+    # kept lines overflow the budget, and then frees half of it so the summary is refreshed
+    # every few turns rather than on every message. The newest `min_lines` are always kept,
+    # truncated to share the budget if they overflow it on their own.
+    if not lines:
+        return 0, []
+    
+    floor = max(len(lines) - max(min_lines, 1), 0)
+    start = min(start, floor)
+    if sum(count_tokens(line) for line in lines[start:]) > max_tokens:
+        start = floor
+        used = sum(count_tokens(line) for line in lines[floor:])
+        while start > 0:
+            tokens = count_tokens(lines[start - 1])
+            if used + tokens > max_tokens // 2:
+                break
+            used += tokens
+            start -= 1
+    
+    kept = lines[start:]
+    if sum(count_tokens(line) for line in kept) > max_tokens:
+        kept = [truncate_tokens(line, max_tokens // len(kept)) for line in kept]
+    return start, kept
+
+@retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception_type(RateLimitError),
+    reraise=True
+)
+async def _acreate(aclient: AsyncOpenAI, **kwargs):
+    # Back off with jitter on 429s; the async client itself is built with max_retries=0
+    # so the two retry loops don't stack
+    return await aclient.chat.completions.create(**kwargs)
+
+def summarize_batch_errors(errors: list[str], limit: int = 3, max_chars: int = 200) -> str:
+    # Batch error messages come straight from the API and repeat per request; show each
+    # distinct one once, shortened, rather than dumping them all into the chat
+    distinct = list(dict.fromkeys(error.strip() for error in errors if error and error.strip()))
+    if not distinct:
+        return "no result was returned"
+    
+    shown = [error if len(error) <= max_chars else error[:max_chars].rstrip() + "…" for error in distinct[:limit]]
+    reason = "; ".join(shown)
+    if len(distinct) > limit:
+        reason += f" (and {len(distinct) - limit} more)"
+    return reason
+
 class OpenAIClient:
-    def __init__(self):
-        # Simple initialization without any additional parameters
-        self.api_key = st.secrets["OPENAI_API_KEY"] if "OPENAI_API_KEY" in st.secrets else os.environ.get("OPENAI_API_KEY")
+    def __init__(self, model: str = "gpt-4o-mini"):
+        self.model = model
+        self.api_key = self._load_api_key()
         if not self.api_key:
             raise Exception("OpenAI API key not found in environment variables or Streamlit secrets")
-        
-        self.client = OpenAI(api_key=self.api_key)  # Only pass api_key
+        # Updated client initialization
+        self.client = OpenAI(
+            api_key=self.api_key,
+            base_url="https://api.openai.com/v1",  # Explicitly set the base URL
+            max_retries=_MAX_RETRIES
+        )
     
     def generate_response(self, prompt: str, context: str = None) -> tuple[str, bool]:
         try:
             messages = self._create_messages(prompt, context)
             response = self.client.chat.completions.create(
-                model="gpt-4",
+                model=self.model,
                 messages=messages,
                 temperature=0.7
             )
@@ -30,19 +152,167 @@ class OpenAIClient:
             error_msg = str(e)
             return error_msg, False
     
-    def _create_messages(self, prompt: str, context: str = None) -> list:
-        base_prompt = {
-            "role": "system",
-            "content": """You are a knowledgeable Saudi Arabia tourism expert. 
-            Provide detailed recommendations based on the user's preferences.
-            Be specific about locations, activities, and cultural considerations.
-            Keep responses friendly and informative."""
-        }
+    def generate_recommendations(self, prompt: str) -> tuple[dict | str, bool]:
+        # One round-trip returns every section as a JSON object keyed by section name
+        try:
+            messages = self._create_messages(prompt, reserved=_fixed_tokens()[1])
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.7,
+                response_format=_RECOMMENDATION_FORMAT
+            )
+            
+            content = response.choices[0].message.content
+            if not content:
+                raise Exception("OpenAI returned an empty response")
+            
+            return json.loads(content), True
+                
+        except Exception as e:
+            error_msg = str(e)
+            return error_msg, False
+    
+    def generate_response_stream(self, prompt: str, context: str = None):
+        # Yields content deltas as they arrive instead of waiting for the full completion
+        messages = self._create_messages(prompt, context)
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=0.7,
+            stream=True
+        )
+        for chunk in stream:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+    
+    async def agenerate_response(self, aclient: AsyncOpenAI, prompt: str, context: str = None) -> tuple[str, bool]:
+        try:
+            messages = self._create_messages(prompt, context)
+            response = await _acreate(
+                aclient,
+                model=self.model,
+                messages=messages,
+                temperature=0.7
+            )
+            
+            content = response.choices[0].message.content
+            if not content:
+                raise Exception("OpenAI returned an empty response")
+            
+            return content, True
+                
+        except Exception as e:
+            error_msg = str(e)
+            return error_msg, False
+    
+    def generate_many(self, prompts: list[tuple[str, str]]) -> list[tuple[str, bool]]:
+        # Issue all (prompt, context) pairs concurrently; results keep input order
+        async def _gather():
+            # asyncio.run() starts a fresh event loop each time, so the async client (and its
+            # connection pool) and the semaphore are created inside this run rather than cached
+            semaphore = asyncio.Semaphore(_MAX_CONCURRENCY)
+            async with AsyncOpenAI(
+                api_key=self.api_key,
+                base_url="https://api.openai.com/v1",
+                max_retries=0
+            ) as aclient:
+                async def _bounded(prompt, context):
+                    async with semaphore:
+                        return await self.agenerate_response(aclient, prompt, context)
+                
+                return await asyncio.gather(
+                    *[_bounded(prompt, context) for prompt, context in prompts]
+                )
+        return asyncio.run(_gather())
+    
+    def submit_batch(self, prompts: list[dict]) -> str:
+        # Queue {"custom_id", "prompt"} items on the Batch API at half the synchronous price
+        lines = [
+            json.dumps({
+                "custom_id": item["custom_id"],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": self._create_messages(item["prompt"], reserved=_fixed_tokens()[1]),
+                    "temperature": 0.7,
+                    "response_format": _RECOMMENDATION_FORMAT
+                }
+            })
+            for item in prompts
+        ]
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+    
+    def retrieve_batch(self, batch_id: str) -> tuple[str, list[dict] | None, list[str]]:
+        # Returns the batch status, the parsed recommendation sections once the batch has
+        # finished (None while it is still running) and a message for every failed request
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status not in _BATCH_FINAL_STATUSES:
+            return batch.status, None, []
+        
+        results = []
+        errors = [error.message or error.code for error in (batch.errors.data or [])] if batch.errors else []
+        # A batch whose requests all failed still ends "completed", with only an error file
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                sections, error = self._parse_batch_record(json.loads(line))
+                if error:
+                    errors.append(error)
+                else:
+                    results.append(sections)
+        return batch.status, results, errors
+    
+    @staticmethod
+    def _parse_batch_record(record: dict) -> tuple[dict | None, str | None]:
+        # Failures here are final: retrying the same output file would fail the same way
+        if record.get("error"):
+            return None, record["error"].get("message") or str(record["error"])
         
-        messages = [base_prompt]
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        if response.get("status_code") != 200:
+            return None, (body.get("error") or {}).get("message") or f"Request failed with status {response.get('status_code')}"
         
+        try:
+            message = body["choices"][0]["message"]
+            if not message.get("content"):
+                return None, message.get("refusal") or "OpenAI returned an empty response"
+            return json.loads(message["content"]), None
+        except (KeyError, IndexError, json.JSONDecodeError):
+            return None, "OpenAI returned a malformed recommendation"
+    
+    @staticmethod
+    def _load_api_key() -> str:
+        # Touching st.secrets without a secrets.toml draws a visible error, so check quietly first
+        if st.secrets.load_if_toml_exists() and "OPENAI_API_KEY" in st.secrets:
+            return st.secrets["OPENAI_API_KEY"]
+        return os.environ.get("OPENAI_API_KEY")
+    
+    @staticmethod
+    def _create_messages(prompt: str, context: str = None, reserved: int = 0) -> list:
+        # Enforce the request-size budget before dispatch: cap the prompt, then give the
+        # context what's left, dropping its oldest part first. `reserved` covers anything
+        # else sent with the request, such as a response_format schema
+        budget = _MAX_PROMPT_TOKENS - _fixed_tokens()[0] - 3 * _MESSAGE_OVERHEAD - _TOKEN_MARGIN - reserved
+        prompt = truncate_tokens(prompt, budget)
         if context:
-            messages.append({"role": "system", "content": f"Previous context: {context}"})
+            remaining = budget - count_tokens(prompt) - count_tokens(_CONTEXT_PREFIX)
+            context = truncate_tokens(context, remaining, keep_end=True) if remaining > 0 else None
         
-        messages.append({"role": "user", "content": prompt})
-        return messages
+        return [
+            _SYSTEM_MESSAGE,
+            *([{"role": "system", "content": f"{_CONTEXT_PREFIX}{context}"}] if context else []),
+            {"role": "user", "content": prompt}
+        ]
@@ -1,68 +1,194 @@
 # streamlit_app.py
 import streamlit as st
-import os
-from openai import OpenAI
 import uuid
+import sqlite3
+from collections import deque
+from contextlib import closing
 from datetime import datetime
 import json
+from openai_helper import OpenAIClient, split_context, summarize_batch_errors, truncate_tokens
 
-# Initialize OpenAI client
-class OpenAIClient:
-    def __init__(self):
-        self.api_key = os.environ.get("OPENAI_API_KEY")
-        if not self.api_key:
-            raise Exception("OpenAI API key not found in environment variables")
-        # Updated client initialization
-        self.client = OpenAI(
-            api_key=self.api_key,
-            base_url="https://api.openai.com/v1"  # Explicitly set the base URL
+# Messages kept in session state; the full history lives in SQLite
+_HISTORY_LIMIT = 50
+# Dropped turns sent to the summarizer; the newest ones matter most
+_SUMMARY_TRANSCRIPT_TOKENS = 4000
+
+
+@st.cache_resource
+def get_openai_client(model: str = "gpt-4o-mini") -> OpenAIClient:
+    # Reuse one client per model (and its HTTP connection pool) across reruns and sessions
+    return OpenAIClient(model=model)
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def _cached_recommendations(prompt: str, model: str) -> dict:
+    sections, success = get_openai_client(model).generate_recommendations(prompt)
+    if not success:
+        # Raise so failed responses are never memoized
+        raise Exception(sections)
+    return sections
+
+_DB_PATH = "chat.db"
+
+@st.cache_resource
+def _init_db():
+    with closing(sqlite3.connect(_DB_PATH)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages "
+            "(session_id TEXT, ts TEXT, role TEXT, content TEXT, sections TEXT)"
         )
+        # At most one pending batch per session, so a reload can still collect it
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches (session_id TEXT PRIMARY KEY, batch_id TEXT)"
+        )
+
+def get_db() -> sqlite3.Connection:
+    # A fresh connection per call: session threads must not share one connection's transactions
+    _init_db()
+    return sqlite3.connect(_DB_PATH)
+
+def persist(session_id: str, message: dict):
+    sections = message.get("sections")
+    with closing(get_db()) as conn, conn:
+        conn.execute(
+            "INSERT INTO messages (session_id, ts, role, content, sections) VALUES (?, ?, ?, ?, ?)",
+            (session_id, message["timestamp"], message["role"], message["content"],
+             json.dumps(sections) if sections else None)
+        )
+
+def load_history(session_id: str) -> deque:
+    # rowid follows insertion order; timestamps can tie or differ in precision
+    with closing(get_db()) as conn:
+        rows = conn.execute(
+            "SELECT ts, role, content, sections FROM messages WHERE session_id = ? ORDER BY rowid DESC LIMIT ?",
+            (session_id, _HISTORY_LIMIT)
+        ).fetchall()
+    history = deque(maxlen=_HISTORY_LIMIT)
+    for ts, role, content, sections in reversed(rows):
+        message = {"role": role, "content": content, "timestamp": ts}
+        if sections:
+            message["sections"] = json.loads(sections)
+        history.append(message)
+    return history
+
+def save_pending_batch(session_id: str, batch_id: str):
+    with closing(get_db()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO batches (session_id, batch_id) VALUES (?, ?)",
+            (session_id, batch_id)
+        )
+
+def load_pending_batch(session_id: str) -> str | None:
+    with closing(get_db()) as conn:
+        row = conn.execute(
+            "SELECT batch_id FROM batches WHERE session_id = ?", (session_id,)
+        ).fetchone()
+    return row[0] if row else None
+
+def clear_pending_batch(session_id: str):
+    with closing(get_db()) as conn, conn:
+        conn.execute("DELETE FROM batches WHERE session_id = ?", (session_id,))
+
+def _add_message(message: dict):
+    # Older entries fall off the bounded deque but stay in the database
+    st.session_state.chat_history.append(message)
+    persist(st.session_state.session_id, message)
+
+@st.cache_data(show_spinner=False, ttl=60)
+def _cached_batch_status(batch_id: str) -> tuple[str, list[dict] | None, list[str]]:
+    return get_openai_client().retrieve_batch(batch_id)
+
+def _append_recommendation(sections: dict):
+    _add_message({
+        "role": "assistant",
+        # Flattened copy so the recommendation can still feed chat context
+        "content": "\n\n".join(f"**{name.title()}**\n{text}" for name, text in sections.items()),
+        "sections": sections,
+        "timestamp": datetime.utcnow().isoformat()
+    })
+
+@st.fragment(run_every=60)
+def _poll_batch():
+    batch_id = st.session_state.batch_id
+    if not batch_id:
+        return
     
-    def generate_response(self, prompt: str, context: str = None) -> tuple[str, bool]:
-        try:
-            messages = self._create_messages(prompt, context)
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=messages,
-                temperature=0.7
-            )
-            
-            content = response.choices[0].message.content
-            if not content:
-                raise Exception("OpenAI returned an empty response")
-            
-            return content, True
-                
-        except Exception as e:
-            error_msg = str(e)
-            return error_msg, False
+    try:
+        status, results, errors = _cached_batch_status(batch_id)
+    except Exception as e:
+        # Network errors are transient; try again on the next poll
+        st.warning(f"Could not check batched recommendations: {str(e)}")
+        return
     
-    def _create_messages(self, prompt: str, context: str = None) -> list:
-        base_prompt = {
-            "role": "system",
-            "content": """You are a knowledgeable Saudi Arabia tourism expert. 
-            Provide detailed recommendations based on the user's preferences.
-            Be specific about locations, activities, and cultural considerations.
-            Keep responses friendly and informative."""
-        }
-        
-        messages = [base_prompt]
-        
-        if context:
-            messages.append({"role": "system", "content": f"Previous context: {context}"})
-        
-        messages.append({"role": "user", "content": prompt})
-        return messages
+    if results is None:
+        st.caption(f"Batched recommendations: {status}")
+        return
+    
+    for sections in results:
+        _append_recommendation(sections)
+    if errors or not results:
+        # Recorded in the chat so the outcome survives the rerun below
+        reason = summarize_batch_errors(errors)
+        _add_message({
+            "role": "assistant",
+            "content": f"Batched recommendations {status}: {reason}. Please try again.",
+            "timestamp": datetime.utcnow().isoformat()
+        })
+    clear_pending_batch(st.session_state.session_id)
+    st.session_state.batch_id = None
+    # Full rerun once so the delivered recommendation shows up in the chat
+    st.rerun()
 
-# Initialize session state
-if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
-if 'session_id' not in st.session_state:
-    st.session_state.session_id = str(uuid.uuid4())
+@st.cache_data(show_spinner=False, ttl=3600)
+def _summarize_turns(summary: str, transcript: str) -> str:
+    transcript = truncate_tokens(transcript, _SUMMARY_TRANSCRIPT_TOKENS, keep_end=True)
+    response, success = get_openai_client("gpt-4o-mini").generate_response(
+        "Update this conversation summary with the new messages, in one or two short sentences.\n"
+        f"Summary so far: {summary or 'none'}\nNew messages:\n{transcript}"
+    )
+    if not success:
+        raise Exception(response)
+    return response
+
+def _pack_context(history: list, max_tokens: int = 1500) -> str:
+    # Keep the newest turns that fit the token budget; older turns are folded into a
+    # running summary that is only refreshed when the cut-off moves. The current question
+    # is already sent as the prompt, so it is left out here.
+    history = list(history)[:-1]
+    lines = [f"{msg['role']}: {msg['content']}" for msg in history]
+    start = next((i for i, msg in enumerate(history) if msg is st.session_state.context_start), 0)
+    # Never drop the latest assistant turn, even if it is longer than the budget
+    last_reply = max((i for i, msg in enumerate(history) if msg["role"] == "assistant"), default=len(history) - 1)
+    cutoff, kept = split_context(lines, max_tokens, start, min_lines=len(history) - last_reply)
+    
+    if cutoff > start:
+        summary = st.session_state.context_summary
+        try:
+            st.session_state.context_summary = _summarize_turns(summary, "\n".join(lines[start:cutoff]))
+        except Exception:
+            st.session_state.context_summary = f"{summary} ({cutoff - start} earlier messages omitted)".strip()
+        st.session_state.context_start = history[cutoff]
+    
+    if st.session_state.context_summary:
+        kept.insert(0, f"[earlier turns summarized: {st.session_state.context_summary}]")
+    return "\n".join(kept)
 
 # Set page config
 st.set_page_config(page_title="Saudi Tourism Assistant", layout="wide")
 
+# Initialize session state
+if 'session_id' not in st.session_state:
+    # Keep the id in the URL so a page reload resumes the same conversation
+    st.session_state.session_id = st.query_params.get("session") or str(uuid.uuid4())
+    st.query_params["session"] = st.session_state.session_id
+if 'chat_history' not in st.session_state:
+    st.session_state.chat_history = load_history(st.session_state.session_id)
+if 'context_start' not in st.session_state:
+    # Oldest message still sent verbatim as context, and a summary of everything before it
+    st.session_state.context_start = None
+    st.session_state.context_summary = ""
+if 'batch_id' not in st.session_state:
+    st.session_state.batch_id = load_pending_batch(st.session_state.session_id)
+
 # Main title
 st.title("Saudi Tourism Assistant")
 
@@ -70,92 +196,112 @@ st.title("Saudi Tourism Assistant")
 with st.sidebar:
     st.header("Trip Preferences")
     
-    location = st.selectbox(
-        "Destination",
-        ["Riyadh", "Jeddah", "Mecca", "Medina", "AlUla"],
-        key="location"
-    )
-    
-    col1, col2 = st.columns(2)
-    with col1:
-        budget = st.number_input("Budget", min_value=0, value=1000)
-    with col2:
-        currency = st.selectbox("Currency", ["SAR", "USD", "EUR"])
-    
-    trip_type = st.selectbox(
-        "Trip Type",
-        ["Religious", "Entertainment", "Business", "Cultural"],
-        key="trip_type"
-    )
-    
-    family = st.text_input("Family Composition (e.g., 2 adults, 1 child)")
-    duration = st.number_input("Duration (days)", min_value=1, value=1)
+    # Inputs inside a form don't rerun the script until the form is submitted
+    with st.form("preferences", clear_on_submit=False):
+        location = st.selectbox(
+            "Destination",
+            ["Riyadh", "Jeddah", "Mecca", "Medina", "AlUla"],
+            key="location"
+        )
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            budget = st.number_input("Budget", min_value=0, value=1000)
+        with col2:
+            currency = st.selectbox("Currency", ["SAR", "USD", "EUR"])
+        
+        trip_type = st.selectbox(
+            "Trip Type",
+            ["Religious", "Entertainment", "Business", "Cultural"],
+            key="trip_type"
+        )
+        
+        family = st.text_input("Family Composition (e.g., 2 adults, 1 child)")
+        duration = st.number_input("Duration (days)", min_value=1, value=1)
+        
+        # Only the initial itinerary can be escalated to the larger model
+        model_quality = st.selectbox(
+            "Model quality",
+            ["fast (gpt-4o-mini)", "high (gpt-4o)"],
+            key="model_quality"
+        )
+        recommendation_model = "gpt-4o" if model_quality.startswith("high") else "gpt-4o-mini"
+        
+        use_batch = st.checkbox("Save 50% — deliver within 24h", key="use_batch")
+        
+        submitted = st.form_submit_button("Get Recommendations")
     
-    if st.button("Get Recommendations"):
+    if submitted:
         try:
-            client = OpenAIClient()
             initial_prompt = f"""Please provide a personalized travel recommendation for Saudi Arabia based on these preferences:
             Location: {location}
             Budget: {budget} {currency}
             Trip Type: {trip_type}
             Family: {family}
-            Duration: {duration} days"""
-            
-            response, success = client.generate_response(initial_prompt)
+            Duration: {duration} days
+            Cover the itinerary, accommodation, attractions, cultural etiquette, budget breakdown and practical tips."""
             
-            if success:
-                st.session_state.chat_history.append({
-                    "role": "assistant",
-                    "content": response,
-                    "timestamp": datetime.utcnow().isoformat()
-                })
+            if use_batch and st.session_state.batch_id:
+                st.warning("A batched recommendation is still pending. Please wait for it before submitting another.")
+            elif use_batch:
+                batch_id = get_openai_client(recommendation_model).submit_batch([
+                    {"custom_id": st.session_state.session_id, "prompt": initial_prompt}
+                ])
+                save_pending_batch(st.session_state.session_id, batch_id)
+                st.session_state.batch_id = batch_id
             else:
-                st.error("Failed to generate recommendations. Please try again.")
+                _append_recommendation(_cached_recommendations(initial_prompt, recommendation_model))
                 
         except Exception as e:
-            st.error(f"An error occurred: {str(e)}")
+            st.error(f"Failed to generate recommendations: {str(e)}")
+    
+    _poll_batch()
 
 # Main chat interface
-chat_container = st.container()
-
-# Display chat history
-with chat_container:
-    for message in st.session_state.chat_history:
-        if message["role"] == "user":
-            st.text_area("You:", value=message["content"], height=100, disabled=True)
+def _render_message(message: dict):
+    with st.chat_message(message["role"]):
+        if "sections" in message:
+            for name, text in message["sections"].items():
+                with st.expander(name.title()):
+                    st.markdown(text)
         else:
-            st.text_area("Assistant:", value=message["content"], height=200, disabled=True)
+            st.markdown(message["content"])
 
-# Chat input
-user_input = st.text_input("Ask a question about your trip:", key="user_input")
-
-if st.button("Send"):
-    if user_input:
-        # Add user message to chat history
-        st.session_state.chat_history.append({
-            "role": "user",
-            "content": user_input,
+@st.fragment
+def _chat():
+    # Holds the chat input, so sending a message reruns only this fragment, not the sidebar
+    for message in st.session_state.chat_history:
+        _render_message(message)
+    
+    user_input = st.chat_input("Ask a question about your trip:")
+    if not user_input:
+        return
+    
+    # Add user message to chat history
+    _add_message({
+        "role": "user",
+        "content": user_input,
+        "timestamp": datetime.utcnow().isoformat()
+    })
+    _render_message(st.session_state.chat_history[-1])
+    
+    try:
+        # Get context from recent messages within the token budget; the first message has none
+        context = None if len(st.session_state.chat_history) <= 1 else _pack_context(st.session_state.chat_history)
+        
+        # Stream the reply in place, no rerun needed
+        with st.chat_message("assistant"):
+            response = st.write_stream(
+                get_openai_client().generate_response_stream(user_input, context)
+            )
+        
+        _add_message({
+            "role": "assistant",
+            "content": response,
             "timestamp": datetime.utcnow().isoformat()
         })
-        
-        try:
-            client = OpenAIClient()
-            
-            # Get context from recent messages
-            recent_messages = st.session_state.chat_history[-5:]
-            context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in recent_messages])
-            
-            response, success = client.generate_response(user_input, context)
             
-            if success:
-                st.session_state.chat_history.append({
-                    "role": "assistant",
-                    "content": response,
-                    "timestamp": datetime.utcnow().isoformat()
-                })
-                st.experimental_rerun()
-            else:
-                st.error("Failed to generate response. Please try again.")
-                
-        except Exception as e:
-            st.error(f"An error occurred: {str(e)}")
+    except Exception as e:
+        st.error(f"Failed to generate response: {str(e)}")
+
+_chat()
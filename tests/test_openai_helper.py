@@ -0,0 +1,252 @@
+import asyncio
+import re
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("openai")
+pytest.importorskip("tiktoken")
+
+import httpx
+from openai import RateLimitError
+from tenacity import wait_none
+
+import openai_helper
+from openai_helper import (
+    OpenAIClient,
+    count_tokens,
+    split_context,
+    summarize_batch_errors,
+    truncate_tokens,
+)
+
+
+class _StubEncoding:
+    # Offline stand-in for tiktoken: one token per ASCII word, one per byte otherwise,
+    # so multibyte characters can be split at a cut the way BPE tokens can
+    def __init__(self):
+        self.ids = {}
+        self.pieces = []
+
+    def _id(self, piece: bytes) -> int:
+        if piece not in self.ids:
+            self.ids[piece] = len(self.pieces)
+            self.pieces.append(piece)
+        return self.ids[piece]
+
+    def encode(self, text: str) -> list[int]:
+        tokens = []
+        for piece in re.findall(r"\s*\S+|\s+", text):
+            data = piece.encode("utf-8")
+            if piece.isascii():
+                tokens.append(self._id(data))
+            else:
+                tokens.extend(self._id(data[i:i + 1]) for i in range(len(data)))
+        return tokens
+
+    def decode(self, tokens: list[int]) -> str:
+        return b"".join(self.pieces[token] for token in tokens).decode("utf-8", errors="replace")
+
+
+_STUB_ENCODING = _StubEncoding()
+
+
+@pytest.fixture(autouse=True)
+def _offline_encoding(monkeypatch):
+    monkeypatch.setattr(openai_helper, "_get_encoding", lambda: _STUB_ENCODING)
+    openai_helper._fixed_tokens.cache_clear()
+    yield
+    openai_helper._fixed_tokens.cache_clear()
+
+
+def _words(n: int, word: str = "word") -> str:
+    return " ".join(f"{word}{i}" for i in range(n))
+
+
+def test_truncate_tokens_leaves_short_text_alone():
+    assert truncate_tokens("hello there", 50) == "hello there"
+
+
+def test_truncate_tokens_keeps_start_or_end():
+    text = _words(200)
+    head = truncate_tokens(text, 20)
+    tail = truncate_tokens(text, 20, keep_end=True)
+    assert count_tokens(head) <= 20 and text.startswith(head)
+    assert count_tokens(tail) <= 20 and text.endswith(tail)
+
+
+def test_truncate_tokens_drops_partial_characters_at_the_cut():
+    text = "مرحبا بكم في الرياض"
+    for max_tokens in range(1, count_tokens(text)):
+        head = truncate_tokens(text, max_tokens)
+        tail = truncate_tokens(text, max_tokens, keep_end=True)
+        assert "\ufffd" not in head and text.startswith(head)
+        assert "\ufffd" not in tail and text.endswith(tail)
+
+
+def test_split_context_keeps_everything_within_budget():
+    lines = ["user: hi", "assistant: hello", "user: where to eat?"]
+    assert split_context(lines, 100) == (0, lines)
+
+
+def test_split_context_frees_half_the_budget_when_it_overflows():
+    lines = [f"user: {_words(20)}" for _ in range(10)]
+    start, kept = split_context(lines, 200)
+    assert start > 0
+    assert kept == lines[start:]
+    assert sum(count_tokens(line) for line in kept) <= 100
+
+
+def test_split_context_keeps_cut_off_while_lines_still_fit():
+    lines = [f"user: {_words(20)}" for _ in range(10)]
+    start, _ = split_context(lines, 200)
+    lines.append("user: one more short question")
+    assert split_context(lines, 200, start)[0] == start
+
+
+def test_split_context_always_keeps_a_truncated_newest_line():
+    lines = ["user: hi", f"assistant: {_words(500)}"]
+    start, kept = split_context(lines, 50)
+    assert start == 1
+    assert len(kept) == 1 and count_tokens(kept[0]) <= 50
+    assert kept[0].startswith("assistant:")
+
+
+def test_split_context_keeps_a_long_latest_reply_verbatim():
+    reply = f"assistant: {_words(150)}"
+    lines = [f"user: {_words(60)}", f"assistant: {_words(60)}", "user: and then?", reply]
+    start, kept = split_context(lines, 200)
+    assert start == 3
+    assert kept == [reply]
+
+
+def test_split_context_min_lines_keeps_reply_before_unanswered_question():
+    lines = ["user: hi", f"assistant: {_words(500)}", "user: still there?"]
+    start, kept = split_context(lines, 100, min_lines=2)
+    assert start == 1
+    assert kept[0].startswith("assistant:") and kept[1] == "user: still there?"
+    assert sum(count_tokens(line) for line in kept) <= 100
+
+
+def test_split_context_handles_empty_history():
+    assert split_context([], 100) == (0, [])
+
+
+def test_create_messages_stays_within_request_budget():
+    reserved = 500
+    messages = OpenAIClient._create_messages(_words(5000), _words(5000, "ctx"), reserved=reserved)
+    total = sum(count_tokens(message["content"]) for message in messages)
+    total += len(messages) * openai_helper._MESSAGE_OVERHEAD + reserved
+    assert total <= openai_helper._MAX_PROMPT_TOKENS
+
+
+def test_create_messages_keeps_newest_context():
+    context = _words(5000, "ctx")
+    messages = OpenAIClient._create_messages(_words(3000), context)
+    assert messages[1]["content"].startswith(openai_helper._CONTEXT_PREFIX)
+    assert context.endswith(messages[1]["content"][len(openai_helper._CONTEXT_PREFIX):])
+
+
+class _FakeAsyncOpenAI:
+    instances = []
+
+    def __init__(self, **kwargs):
+        self.chat = SimpleNamespace(completions=self)
+        self.closed = False
+        self.max_retries = kwargs.get("max_retries")
+        self.in_flight = 0
+        self.peak = 0
+        self.rate_limited = set()
+        _FakeAsyncOpenAI.instances.append(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+    async def create(self, model, messages, temperature):
+        prompt = messages[-1]["content"]
+        if prompt.startswith("busy") and prompt not in self.rate_limited:
+            self.rate_limited.add(prompt)
+            request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+            raise RateLimitError("rate limited", response=httpx.Response(429, request=request), body=None)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        reply = SimpleNamespace(content=messages[-1]["content"].upper())
+        return SimpleNamespace(choices=[SimpleNamespace(message=reply)])
+
+
+def test_generate_many_opens_a_fresh_async_client_per_run(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(openai_helper, "AsyncOpenAI", _FakeAsyncOpenAI)
+    _FakeAsyncOpenAI.instances = []
+    client = OpenAIClient()
+
+    assert client.generate_many([("one", None), ("two", "ctx")]) == [("ONE", True), ("TWO", True)]
+    assert client.generate_many([("three", None)]) == [("THREE", True)]
+    assert len(_FakeAsyncOpenAI.instances) == 2
+    assert all(instance.closed for instance in _FakeAsyncOpenAI.instances)
+
+
+def test_generate_many_bounds_concurrency_and_retries_rate_limits(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(openai_helper, "AsyncOpenAI", _FakeAsyncOpenAI)
+    monkeypatch.setattr(openai_helper, "_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(openai_helper._acreate.retry, "wait", wait_none())
+    _FakeAsyncOpenAI.instances = []
+
+    results = OpenAIClient().generate_many([(f"q{i}", None) for i in range(5)] + [("busy", None)])
+
+    assert results[-1] == ("BUSY", True)
+    (aclient,) = _FakeAsyncOpenAI.instances
+    assert aclient.peak == 2
+    assert aclient.max_retries == 0
+
+
+def _batch_record(content=None, status_code=200, refusal=None, error=None):
+    message = {"role": "assistant", "content": content, "refusal": refusal}
+    body = {"choices": [{"message": message}]} if status_code == 200 else {"error": {"message": "Invalid model"}}
+    return {"custom_id": "s1", "response": {"status_code": status_code, "body": body}, "error": error}
+
+
+def test_parse_batch_record_returns_sections():
+    record = _batch_record(content='{"itinerary": "Day 1", "tips": "Bring water"}')
+    assert OpenAIClient._parse_batch_record(record) == ({"itinerary": "Day 1", "tips": "Bring water"}, None)
+
+
+def test_parse_batch_record_reports_record_errors():
+    record = {"custom_id": "s1", "response": None, "error": {"code": "batch_expired", "message": "Request expired"}}
+    assert OpenAIClient._parse_batch_record(record) == (None, "Request expired")
+
+
+def test_parse_batch_record_reports_non_200_responses():
+    assert OpenAIClient._parse_batch_record(_batch_record(status_code=400)) == (None, "Invalid model")
+
+
+@pytest.mark.parametrize("record, expected", [
+    (_batch_record(refusal="I can't help with that."), "I can't help with that."),
+    (_batch_record(content=""), "OpenAI returned an empty response"),
+])
+def test_parse_batch_record_reports_refusals_and_empty_replies(record, expected):
+    assert OpenAIClient._parse_batch_record(record) == (None, expected)
+
+
+@pytest.mark.parametrize("record", [
+    _batch_record(content='{"itinerary": "Day 1, then'),
+    {"custom_id": "s1", "response": {"status_code": 200, "body": {"choices": []}}},
+])
+def test_parse_batch_record_treats_malformed_replies_as_final(record):
+    assert OpenAIClient._parse_batch_record(record) == (None, "OpenAI returned a malformed recommendation")
+
+
+def test_summarize_batch_errors_dedupes_and_shortens():
+    errors = ["Request expired", "Request expired", "x" * 300, "third", "fourth"]
+    reason = summarize_batch_errors(errors)
+    assert reason.count("Request expired") == 1
+    assert "x" * 201 not in reason
+    assert reason.endswith("(and 1 more)")
+    assert summarize_batch_errors([]) == "no result was returned"